@@ -1,21 +1,18 @@
 import zipfile
 import os
+import re
+import struct
+import sys
+import inspect
+import functools
+import threading
+import collections
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 __version__ = '0.156'
 
-try:
-    from functools import lru_cache
-except (ImportError, AttributeError):
-    # don't know how to tell setup.py that we only need functools32 when under 2.7.
-    # so we'll just include a copy (*bergh*)
-    import sys
-
-    sys.path.append(os.path.join(os.path.dirname(__file__), "functools32"))
-    from functools32 import lru_cache
-
 
 class WideNotSupported(ValueError):
     def __init__(self):
@@ -27,7 +24,9 @@ class WideNotSupported(ValueError):
 class CantApplyExclusion(ValueError):
     pass
 
-datasets_to_cache = 32
+default_cache_bytes = 4 * 1024 ** 3
+part_loading_threads = None  # None = os.cpu_count()
+background_threads = 4  # for prefetch() and aget_*()
 
 known_compartment_columns = [
     "compartment",
@@ -40,6 +39,685 @@ known_compartment_columns = [
 ]  # tissue
 
 
+filterable_columns = ["variable", "unit", "patient"] + known_compartment_columns
+# precomputed get_wide(dataset) results live in _wide/<dataset>
+stored_wide_prefix = "_wide/"
+
+
+def normalize_filters(filters):
+    """Turn a {column: value or [values]} dict into a hashable, sorted
+    tuple of (column, (sorted values,...)) - or None if there is nothing to filter on.
+    """
+    if not filters:
+        return None
+    if isinstance(filters, dict):
+        filters = filters.items()
+    result = []
+    for column, values in filters:
+        if column not in filterable_columns:
+            raise ValueError(
+                "Can only filter on %s, not on %s" % (filterable_columns, column)
+            )
+        if isinstance(values, (str, bytes)) or not hasattr(values, "__iter__"):
+            values = (values,)
+        result.append((column, tuple(sorted(set(values), key=str))))
+    return tuple(sorted(result))
+
+
+def merge_filters(a, b):
+    """Combine two normalized filters. A column in both keeps the values in both"""
+    if not a:
+        return b
+    if not b:
+        return a
+    merged = dict(a)
+    for column, values in b:
+        if column in merged:
+            values = set(values)
+            values = tuple(x for x in merged[column] if x in values)
+        merged[column] = values
+    return tuple(sorted(merged.items()))
+
+
+def filter_df(df, filters):
+    """Apply normalized @filters to a (tall) DataFrame in pandas"""
+    if not filters:
+        return df
+    keep = np.ones((len(df),), bool)
+    for column, values in filters:
+        if column not in df.columns:
+            raise ValueError("Can not filter on %s - not in dataset" % column)
+        keep &= df[column].isin(values).values
+    return df[keep]
+
+
+def _arrow_filter_values(arrow_type, values):
+    """The filter @values that could match a column of @arrow_type, as a pyarrow array.
+    Values of another type are dropped (pandas' isin never matches them either) -
+    pyarrow would raise on them."""
+    import pyarrow
+
+    if pyarrow.types.is_dictionary(arrow_type):
+        arrow_type = arrow_type.value_type
+    result = []
+    for value in values:
+        try:
+            pyarrow.scalar(value, type=arrow_type)
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError, ValueError):
+            continue
+        result.append(value)
+    return pyarrow.array(result, type=arrow_type)
+
+
+def _concat_parts(dfs):
+    """Concatenate the unit split parts of a dataset.
+
+    Categorical columns are merged with union_categoricals (which remaps the codes)
+    instead of rebuilding them from the concatenated values.
+    Like before, the resulting categories are the sorted, observed values.
+    """
+    from pandas.api.types import union_categoricals
+
+    non_empty = [df for df in dfs if len(df)]
+    if non_empty:
+        dfs = non_empty
+    if len(dfs) == 1:
+        return dfs[0]
+    columns = list(dfs[0].columns)
+    categoricals = [c for c in columns if dfs[0][c].dtype.name == "category"]
+    uniform = all(
+        list(df.columns) == columns
+        and all(df[c].dtype.name == "category" for c in categoricals)
+        for df in dfs
+    )
+    if uniform:
+        try:
+            merged = {
+                c: union_categoricals(
+                    [df[c] for df in dfs], sort_categories=True
+                ).remove_unused_categories()
+                for c in categoricals
+            }
+        except TypeError:  # eg. categories of different dtypes
+            uniform = False
+    if not uniform:
+        categoricals = set()
+        for df in dfs:
+            for c, dt in df.dtypes.items():
+                if dt.name == "category":
+                    categoricals.add(c)
+        df = pd.concat(dfs)
+        reps = {c: pd.Categorical(df[c]) for c in categoricals}
+        if reps:
+            df = df.assign(**reps)
+        return df
+    df = pd.concat([df.drop(columns=categoricals) for df in dfs])
+    if merged:
+        df = df.assign(**merged)[columns]
+    return df
+
+
+def _freeze(value):
+    """Turn (nested) lists/dicts/sets into something hashable for cache keys"""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for (k, v) in value.items()))
+    elif isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    elif isinstance(value, (set, frozenset)):
+        return tuple(sorted(_freeze(x) for x in value))
+    elif isinstance(value, np.ndarray):
+        return tuple(_freeze(x) for x in value.tolist())
+    return value
+
+
+def estimate_size(value):
+    """Rough size of a cached value in bytes"""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        try:
+            size = value.memory_usage(deep=True, index=True)
+        except TypeError:  # pandas can't 'deep' inspect object SparseArrays
+            size = value.memory_usage(deep=False, index=True)
+        return int(size.sum()) if isinstance(value, pd.DataFrame) else int(size)
+    elif isinstance(value, np.ndarray):
+        return value.nbytes
+    elif isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            estimate_size(k) + estimate_size(v) for (k, v) in value.items()
+        )
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        return sys.getsizeof(value) + sum(estimate_size(x) for x in value)
+    return sys.getsizeof(value)
+
+
+class ByteBudgetCache(object):
+    """A thread safe least-recently-used cache that evicts
+    once the (estimated) size of its values exceeds @max_bytes"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._entries = collections.OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, _size = self._entries[key]
+            except KeyError:
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        size = estimate_size(value)
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:  # would evict everything - don't bother
+                return
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _key, (_value, old_size) = self._entries.popitem(last=False)
+                self.current_bytes -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+def _frame_to_table(df):
+    """DataFrame -> pyarrow.Table.
+    Column labels are stored as json in the schema metadata, since pyarrow
+    can't restore tuple labels containing NaN (standardized get_wide)"""
+    import json
+    import pyarrow
+
+    columns = {
+        "multi": isinstance(df.columns, pd.MultiIndex),
+        "names": list(df.columns.names),
+        "values": [list(x) if isinstance(x, tuple) else x for x in df.columns],
+    }
+    flat = df.set_axis([str(ii) for ii in range(len(df.columns))], axis=1)
+    table = pyarrow.Table.from_pandas(flat)
+    metadata = dict(table.schema.metadata or {})
+    metadata[b"marburg_biobank_columns"] = json.dumps(columns).encode("utf-8")
+    return table.replace_schema_metadata(metadata)
+
+
+def _table_to_frame(table):
+    import json
+
+    columns = json.loads(table.schema.metadata[b"marburg_biobank_columns"])
+    df = table.to_pandas()
+    if columns["multi"]:
+        df.columns = pd.MultiIndex.from_tuples(
+            [tuple(x) for x in columns["values"]], names=columns["names"]
+        )
+    else:
+        df.columns = pd.Index(columns["values"], name=columns["names"][0])
+    return df
+
+
+class DiskCache(object):
+    """A persistent cache of DataFrames stored as (uncompressed) Arrow IPC files
+    in @cache_dir, which are memory mapped when read back.
+
+    @namespace must identify the biobank file (content & revision) -
+    it's hashed together with the key into the filename.
+    """
+
+    def __init__(self, cache_dir, namespace):
+        try:
+            import pyarrow.ipc  # noqa: F401
+        except ImportError:
+            raise ValueError("The on disk cache (cache_dir=) needs pyarrow")
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.namespace = namespace
+
+    def _path(self, key):
+        import hashlib
+
+        h = hashlib.sha256((self.namespace + repr(key)).encode("utf-8")).hexdigest()
+        return self.cache_dir / (h + ".arrow")
+
+    def get(self, key, default=None):
+        import pyarrow
+        import pyarrow.ipc
+
+        path = self._path(key)
+        if not path.exists():
+            return default
+        try:
+            table = pyarrow.ipc.open_file(pyarrow.memory_map(str(path))).read_all()
+            return _table_to_frame(table)
+        except (OSError, KeyError, TypeError, ValueError, pyarrow.ArrowInvalid):
+            return default  # a broken / foreign file - will be overwritten
+
+    def put(self, key, df):
+        import pyarrow
+        import pyarrow.ipc
+
+        if not isinstance(df, pd.DataFrame):
+            return
+        try:
+            table = _frame_to_table(df)
+        except (
+            TypeError,
+            ValueError,
+            pyarrow.ArrowInvalid,
+            pyarrow.ArrowTypeError,
+            pyarrow.ArrowNotImplementedError,
+        ):  # e.g. mixed type object columns - keep it in memory only
+            return
+        path = self._path(key)
+        temp_path = path.with_name(
+            "%s.%i.%i.tmp" % (path.name, os.getpid(), threading.get_ident())
+        )
+        with pyarrow.OSFile(str(temp_path), "wb") as sink:
+            with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(temp_path, path)
+
+
+_missing = object()
+
+
+def _call_key(name, signature, self, args, kwargs):
+    """Hashable key for a method call, with defaults filled in"""
+    bound = signature.bind(self, *args, **kwargs)
+    bound.apply_defaults()
+    return (name,) + _freeze(tuple(bound.arguments.items())[1:])
+
+
+def cached_method(func=None, on_disk=False):
+    """Cache a Biobank method's result in the instance's ByteBudgetCache.
+
+    The key is the function name plus the (default filled) arguments,
+    so get_wide(ds) and get_wide(ds, apply_exclusion=True) share an entry.
+
+    With @on_disk, DataFrame results are also stored in the Biobank's
+    DiskCache (if it has one), unless an argument is a callable (filter_func).
+    """
+    if func is None:
+        return functools.partial(cached_method, on_disk=on_disk)
+    signature = inspect.signature(func)
+
+    def cache_key(self, args, kwargs):
+        return _call_key(func.__name__, signature, self, args, kwargs)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = cache_key(self, args, kwargs)
+        result = self._cache.get(key, _missing)
+        if result is _missing:
+            disk_cache = None
+            if (
+                on_disk
+                and self._disk_cache is not None
+                and not any(callable(v) for (_, v) in key[1:])
+            ):
+                disk_cache = self._disk_cache
+                result = disk_cache.get(key, _missing)
+            if result is _missing:
+                result = func(self, *args, **kwargs)
+                if disk_cache is not None:
+                    disk_cache.put(key, result)
+            self._cache.put(key, result)
+        return result
+
+    wrapper.cache_key = cache_key
+    return wrapper
+
+
+def _pivot_key_codes(series):
+    """Integer codes (-1 = NaN) and their labels for one to_wide key column"""
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes = series.cat.codes.values.astype(np.int64)
+        labels = pd.CategoricalIndex(series.cat.categories, dtype=series.dtype)
+    else:
+        codes, labels = pd.factorize(series, sort=True)
+        codes = codes.astype(np.int64)
+    return codes, labels
+
+
+def _pivot_combine_keys(df, keys, appearance_order):
+    """Number the distinct combinations of @keys.
+
+    Returns (id per row, codes per key level, labels per key level) -
+    or None if the combined key space would overflow int64.
+    Ids are in sorted (code) order, or in order of first appearance
+    (which is what unstack does for multiple column levels).
+    """
+    all_codes = []
+    all_labels = []
+    for key in keys:
+        codes, labels = _pivot_key_codes(df[key])
+        all_codes.append(codes + 1)  # NaN (-1) sorts first, like unstack does
+        all_labels.append(labels)
+    dims = [len(labels) + 1 for labels in all_labels]
+    if np.prod([float(x) for x in dims]) >= 2 ** 62:
+        return None
+    combined = np.ravel_multi_index(all_codes, dims)
+    key_space = int(np.prod(dims))
+    if key_space <= max(4 * len(combined), 1 << 20):
+        # small enough for lookup tables - avoids sorting
+        present = np.zeros(key_space, bool)
+        present[combined] = True
+        unique = np.flatnonzero(present)
+        ids = (np.cumsum(present) - 1)[combined]
+        if appearance_order:
+            first_in_space = np.empty(key_space, np.int64)
+            # reversed, so the first occurrence is written last
+            first_in_space[combined[::-1]] = np.arange(len(combined))[::-1]
+            first = first_in_space[unique]
+    else:
+        unique, first, ids = np.unique(
+            combined, return_index=True, return_inverse=True
+        )
+        ids = ids.reshape(-1)
+    if appearance_order:
+        order = np.argsort(first, kind="stable")
+        unique = unique[order]
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        ids = rank[ids]
+    level_codes = [codes - 1 for codes in np.unravel_index(unique, dims)]
+    return ids, level_codes, all_labels
+
+
+def _take_labels(labels, codes):
+    """labels.take(codes) - but code -1 is NaN, not the last label"""
+    if isinstance(labels, pd.CategoricalIndex):
+        return pd.CategoricalIndex(pd.Categorical.from_codes(codes, dtype=labels.dtype))
+    if not len(labels):
+        return pd.Index(np.full(len(codes), np.nan, dtype=object))
+    taken = labels.take(np.maximum(codes, 0))
+    if (codes < 0).any():
+        taken = taken.where(codes >= 0, np.nan)
+    return taken
+
+
+def _distinct_key_rows(df, keys):
+    """The distinct (df[key] for key in keys) tuples, in order of first appearance.
+    Works on the codes - the labels are only looked up once per distinct row"""
+    combined = _pivot_combine_keys(df, keys, True)
+    if combined is None:
+        return list(df[keys].drop_duplicates().itertuples(index=False, name=None))
+    _, all_codes, all_labels = combined
+    columns = []
+    for codes, labels in zip(all_codes, all_labels):
+        columns.append(np.asarray(_take_labels(labels, codes), dtype=object))
+    return list(zip(*columns))
+
+
+def _pivot_column_index(col_codes, col_labels, columns):
+    """The to_wide column index from _pivot_combine_keys' codes & labels"""
+    # plain (non categorical) column levels, so columns can be added later on
+    if len(columns) == 1:
+        return pd.Index(list(_take_labels(col_labels[0], col_codes[0])), name=columns[0])
+    return pd.MultiIndex(
+        levels=[list(x) for x in col_labels], codes=col_codes, names=columns
+    )
+
+
+def _wide_column_index(df, columns):
+    """The column index to_wide(df, ..., columns) produces - without pivoting"""
+    df = df.assign(**{x: np.nan for x in columns if x not in df.columns})
+    cols = _pivot_combine_keys(df, columns, len(columns) > 1)
+    if cols is None:
+        keys = df[columns].drop_duplicates()
+        if len(columns) == 1:
+            return pd.Index(sorted(keys[columns[0]]), name=columns[0])
+        return pd.MultiIndex.from_frame(keys)
+    _, col_codes, col_labels = cols
+    return _pivot_column_index(col_codes, col_labels, columns)
+
+
+def _pivot_by_codes(df, index, columns, column, sparse=False, dtype=None):
+    """Vectorized to_wide for numeric values.
+
+    Scatters the value column into a preallocated matrix using the codes of
+    the (categorical) index & column keys, instead of set_index/unstack and
+    a per column dtype fixup.
+    With @sparse, the columns are SparseArrays (fill value NaN) built straight
+    from the codes, without a dense intermediate.
+    @dtype (a float type) is the dtype of the matrix that's written into.
+    Returns None if the values are not numeric (or the keys too many),
+    so the caller can fall back to unstacking.
+    """
+    values = df[column]
+    if not (
+        pd.api.types.is_float_dtype(values.dtype)
+        or pd.api.types.is_integer_dtype(values.dtype)
+    ) or isinstance(values.dtype, pd.CategoricalDtype):
+        return None
+    rows = _pivot_combine_keys(df, index, False)
+    cols = _pivot_combine_keys(df, columns, len(columns) > 1)
+    if rows is None or cols is None:
+        return None
+    row_ids, row_codes, row_labels = rows
+    col_ids, col_codes, col_labels = cols
+    n_rows = len(row_codes[0])
+    n_cols = len(col_codes[0])
+    values = values.values
+    if len(index) == 1:
+        row_index = _take_labels(row_labels[0], row_codes[0]).rename(index[0])
+    else:
+        row_index = pd.MultiIndex(levels=row_labels, codes=row_codes, names=index)
+    column_index = _pivot_column_index(col_codes, col_labels, columns)
+    if sparse:
+        return _sparse_frame_from_codes(
+            row_ids, col_ids, values, n_rows, row_index, column_index, dtype
+        )
+    positions = row_ids.astype(np.int64) * n_cols + col_ids
+    occupied = np.zeros(n_rows * n_cols, bool)
+    occupied[positions] = True
+    if np.count_nonzero(occupied) != len(positions):
+        raise ValueError("Index contains duplicate entries, cannot reshape")
+    if (
+        dtype is None
+        and len(positions) == n_rows * n_cols
+        and pd.api.types.is_integer_dtype(values.dtype)
+    ):  # nothing missing - stays an integer matrix, like unstack does
+        matrix = np.empty((n_rows, n_cols), dtype=values.dtype)
+    else:
+        matrix = np.full((n_rows, n_cols), np.nan, dtype=dtype or np.float64)
+    matrix.flat[positions] = values
+    return pd.DataFrame(matrix, index=row_index, columns=column_index)
+
+
+def _sparse_frame_from_codes(
+    row_ids, col_ids, values, n_rows, row_index, column_index, dtype=None
+):
+    """One SparseArray (fill value NaN) per column, from (row, column, value) triples.
+    Uses scipy.sparse if available - otherwise each column is densified once."""
+    n_cols = len(column_index)
+    order = np.argsort(col_ids.astype(np.int64) * n_rows + row_ids, kind="stable")
+    row_ids = row_ids[order]
+    col_ids = col_ids[order]
+    dtype = np.dtype(dtype or np.float64)
+    values = values[order].astype(dtype)
+    same = (row_ids[1:] == row_ids[:-1]) & (col_ids[1:] == col_ids[:-1])
+    if same.any():
+        raise ValueError("Index contains duplicate entries, cannot reshape")
+    sparse_dtype = pd.SparseDtype(dtype, np.nan)
+    try:
+        import scipy.sparse
+    except ImportError:
+        bounds = np.searchsorted(col_ids, np.arange(n_cols + 1))
+        column = np.empty(n_rows, dtype)
+        arrays = {}
+        for ii in range(n_cols):
+            start, stop = bounds[ii], bounds[ii + 1]
+            column.fill(np.nan)
+            column[row_ids[start:stop]] = values[start:stop]
+            arrays[ii] = pd.arrays.SparseArray(column, dtype=sparse_dtype)
+        res = pd.DataFrame(arrays, index=row_index)
+    else:
+        matrix = scipy.sparse.csc_matrix(
+            (values, (row_ids, col_ids)), shape=(n_rows, n_cols)
+        )
+        # from_spmatrix fills with 0 - turn the unstored entries into NaN,
+        # stored zeros stay zeros
+        res = pd.DataFrame.sparse.from_spmatrix(matrix, index=row_index).astype(
+            sparse_dtype
+        )
+    res.columns = column_index
+    return res
+
+
+def _excluded_columns(columns, patients, partial):
+    """Boolean mask of the wide DataFrame @columns to exclude.
+
+    The first level is the patient - @patients are excluded completely.
+    The rows of @partial (patient, compartment, ...) exclude the columns
+    that match them on all levels they share with @columns (get_wide leaves
+    off compartment levels with a single value).
+    """
+    mask = columns.get_level_values(0).isin(patients)
+    if len(partial):
+        shared = [x for x in partial.columns if x in columns.names]
+        if shared:
+            keys = columns.to_frame(index=False)[shared].astype(object)
+            hits = keys.merge(
+                partial[shared].astype(object).drop_duplicates(),
+                how="left",
+                on=shared,
+                indicator=True,
+            )
+            mask |= (hits["_merge"] == "both").values
+    return mask
+
+
+def _key_codes(values):
+    """Integer codes (-1 = NaN) and their labels of a tall key column"""
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        return values.cat.codes.values, values.cat.categories
+    return pd.factorize(values)
+
+
+def _excluded_rows(df, patients, partial):
+    """Boolean mask of the tall @df rows to exclude.
+
+    An anti-join on the key codes: @patients are looked up once in the patient
+    categories, the rows of @partial (patient, compartment, ...) are matched
+    on the columns they share with @df, with their codes combined into
+    one integer key per row.
+    """
+    codes, labels = _key_codes(df["patient"])
+    wanted = labels.get_indexer(patients)
+    mask = np.isin(codes, wanted[wanted >= 0])
+    if len(partial):
+        shared = [x for x in partial.columns if x in df.columns]
+        left = []
+        right = []
+        dims = []
+        for column in shared:
+            codes, labels = _key_codes(df[column])
+            values = partial[column]
+            wanted = labels.get_indexer(values)
+            # unknown values must not match the NaN (-1) rows
+            wanted[(wanted < 0) & values.notnull().values] = -2
+            left.append(codes.astype(np.int64) + 2)
+            right.append(wanted + 2)
+            dims.append(len(labels) + 2)
+        if np.prod([float(x) for x in dims]) < 2 ** 62:
+            mask |= np.isin(
+                np.ravel_multi_index(left, dims), np.ravel_multi_index(right, dims)
+            )
+        else:
+            hits = pd.DataFrame(dict(zip(shared, left))).merge(
+                pd.DataFrame(dict(zip(shared, right))).drop_duplicates(),
+                how="left",
+                on=shared,
+                indicator=True,
+            )
+            mask |= (hits["_merge"] == "both").values
+    return mask
+
+
+variable_index_columns = ["dataset", "variable", "name", "unit", "rows"]
+
+
+def build_variable_index(datasets):
+    """The variable index (_meta/_variable_index, see Biobank.find_variable)
+    of an iterable of (dataset, tall DataFrame).
+
+    One row per dataset and distinct (variable, name, unit), with the number
+    of rows it occurs in. A dataset may be passed in several (unit split) parts.
+    """
+    counts = []
+    for dataset, df in datasets:
+        if "variable" not in df.columns:
+            continue
+        keys = [x for x in ["variable", "name", "unit"] if x in df.columns]
+        part = (
+            df.groupby(keys, observed=True, dropna=False, sort=False)
+            .size()
+            .rename("rows")
+            .reset_index()
+        )
+        part = part.assign(
+            dataset=dataset, **{x: np.nan for x in ["name", "unit"] if x not in keys}
+        )
+        counts.append(
+            part[variable_index_columns].astype(
+                {x: object for x in ["variable", "name", "unit"]}
+            )
+        )
+    if not counts:
+        return pd.DataFrame({x: [] for x in variable_index_columns})
+    index = (
+        pd.concat(counts, ignore_index=True)
+        .groupby(variable_index_columns[:-1], dropna=False)["rows"]
+        .sum()
+        .reset_index()
+    )
+    return index.astype({x: "category" for x in variable_index_columns[:-1]})
+
+
+def summarize_dataset(parts):
+    """The summary (see Biobank.get_dataset_summary) of a dataset,
+    from its (unit split) tall DataFrames"""
+    compartment_columns = [
+        x for x in known_compartment_columns if any(x in df.columns for df in parts)
+    ]
+    rows = 0
+    distinct = {"patient": set(), "variable": set(), "unit": set()}
+    compartments = set()
+    for df in parts:
+        rows += len(df)
+        for column, values in distinct.items():
+            if column in df.columns:
+                values.update(df[column].dropna().unique())
+        if compartment_columns:
+            compartments.update(
+                _distinct_key_rows(
+                    df.reindex(columns=compartment_columns), compartment_columns
+                )
+            )
+    return {
+        "rows": rows,
+        "patients": len(distinct["patient"]),
+        "variables": len(distinct["variable"]),
+        "units": sorted(distinct["unit"], key=str),
+        "compartment_columns": compartment_columns,
+        "compartments": sorted(
+            ([None if pd.isnull(x) else x for x in row] for row in compartments),
+            key=str,
+        ),
+    }
+
+
 def lazy_member(field):
     """Evaluate a function once and store the result in the member (an object specific in-memory cache)
     Beware of using the same name in subclasses!
@@ -66,12 +744,21 @@ class Biobank(object):
     Also used internally by the biobank website to access the data.
 
     In essence, a souped up dict of pandas dataframes stored
-    as pickles in a zip file with memory caching"""
+    as pickles in a zip file with memory caching.
 
-    def __init__(self, filename):
+    @cache_bytes is the memory budget of the (per instance) cache of
+    loaded datasets / wide DataFrames. Least recently used entries are evicted first.
+
+    @cache_dir optionally names a directory where get_dataset / get_wide
+    results are persisted (as Arrow IPC files) across processes.
+    """
+
+    def __init__(self, filename, cache_bytes=default_cache_bytes, cache_dir=None):
         self.filename = filename
+        self._cache = ByteBudgetCache(cache_bytes)
         self.zf = zipfile.ZipFile(filename)
-        if not "_meta/_data_format" in self.zf.namelist():
+        infos = self.zf.infolist()
+        if not any(info.filename == "_meta/_data_format" for info in infos):
             self.data_format = "msg_pack"
         else:
             with self.zf.open("_meta/_data_format") as op:
@@ -81,7 +768,211 @@ class Biobank(object):
                 "Unexpected data format (%s). Do you need to update marburg_biobank"
                 % (self.data_format)
             )
-        self._cached_datasets = {}
+        self._members = self._build_member_index(infos)
+        self._stored_wide = {
+            name[len(stored_wide_prefix) :]: self._members.pop(name)["parts"][0]
+            for name in list(self._members)
+            if name.startswith(stored_wide_prefix)
+        }
+        self._mmap = self._open_mmap()
+        if cache_dir is not None:
+            self._disk_cache = DiskCache(
+                cache_dir,
+                "%s/%s/%s"
+                % (__version__, self._content_hash(infos), self._read_revision()),
+            )
+        else:
+            self._disk_cache = None
+        self._footers = {}  # member name -> parquet FileMetaData
+        self._background_pool = None
+        self._background_lock = threading.Lock()
+        self._in_flight = {}  # cache key -> Future, see _run_async
+
+    def clear_cache(self):
+        """Forget all (in memory) cached datasets / wide DataFrames"""
+        self._cache.clear()
+
+    def close(self):
+        """Release the biobank file (and the caches). The Biobank can't be used afterwards"""
+        self.clear_cache()
+        self._footers.clear()
+        with self._background_lock:
+            if self._background_pool is not None:
+                self._background_pool.shutdown(wait=False)
+                self._background_pool = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:  # DataFrames still use it - it's closed with them
+                pass
+            self._mmap = None
+        self.zf.close()
+
+    def _submit_background(self, func, *args, **kwargs):
+        """Run func(*args, **kwargs) on the (lazily created) background thread pool.
+        Returns a concurrent.futures.Future"""
+        with self._background_lock:
+            return self._background_pool_submit(func, *args, **kwargs)
+
+    def _background_pool_submit(self, func, *args, **kwargs):
+        # caller holds _background_lock
+        if self._background_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self._background_pool = ThreadPoolExecutor(
+                background_threads, thread_name_prefix="biobank"
+            )
+        return self._background_pool.submit(func, *args, **kwargs)
+
+    async def _run_async(self, method, *args, **kwargs):
+        """Run a method on the background pool without blocking the event loop.
+        Concurrent calls with the same arguments share one load."""
+        import asyncio
+
+        if hasattr(method, "cache_key"):  # a @cached_method - maybe we have it already
+            key = method.cache_key(self, args, kwargs)
+            result = self._cache.get(key, _missing)
+            if result is not _missing:
+                return result
+        else:
+            key = _call_key(
+                method.__name__, inspect.signature(method), self, args, kwargs
+            )
+        with self._background_lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                future = self._background_pool_submit(method, self, *args, **kwargs)
+                self._in_flight[key] = future
+
+                def forget(f, key=key):
+                    if self._in_flight.get(key) is f:
+                        del self._in_flight[key]
+
+                future.add_done_callback(forget)
+        # shield: one awaiting task being cancelled must not cancel the shared load
+        return await asyncio.shield(asyncio.wrap_future(future))
+
+    async def aget_dataset(self, *args, **kwargs):
+        """get_dataset() for asyncio code - see there for the arguments"""
+        return await self._run_async(Biobank.get_dataset, *args, **kwargs)
+
+    async def aget_wide(self, *args, **kwargs):
+        """get_wide() for asyncio code - see there for the arguments"""
+        import asyncio
+
+        # normalized first, so aliases & equivalent filters share one load
+        # (resolving variables= may need to load the dataset - not on the event loop)
+        bound = inspect.signature(Biobank._wide_call).bind(self, *args, **kwargs)
+        if bound.arguments.get("variables") is not None:
+            method, call_args = await asyncio.wrap_future(
+                self._submit_background(self._wide_call, *args, **kwargs)
+            )
+        else:
+            method, call_args = self._wide_call(*args, **kwargs)
+        return await self._run_async(method, *call_args)
+
+    def prefetch(self, datasets, wide=False):
+        """Start loading @datasets into the cache in the background.
+
+        With @wide, get_wide() (default arguments) is prefetched instead of
+        get_dataset() - for datasets that support it.
+
+        Returns a PrefetchHandle, call .wait() on it to block until everything
+        has been loaded (and to see any exceptions)."""
+        if isinstance(datasets, str):
+            datasets = [datasets]
+
+        def load(dataset):
+            if wide and self.has_wide(self.dataset_exists(dataset)):
+                self.get_wide(dataset)
+            else:
+                self.get_dataset(dataset)
+
+        futures = collections.OrderedDict()
+        for dataset in datasets:
+            futures[dataset] = self._submit_background(load, dataset)
+        return PrefetchHandle(futures)
+
+    def _content_hash(self, infos):
+        """Identify the zip's content by it's members' names, CRCs and sizes"""
+        import hashlib
+
+        h = hashlib.sha256()
+        for info in sorted(infos, key=lambda info: info.filename):
+            h.update(
+                ("%s\t%08x\t%i\n" % (info.filename, info.CRC, info.file_size)).encode(
+                    "utf-8"
+                )
+            )
+        return h.hexdigest()
+
+    def _read_revision(self):
+        if self.data_format != "parquet" or "_meta/biobank" not in self._members:
+            return ""
+        df = self.__load_df_from_parquet("_meta/biobank")
+        revision = df["value"][df["variable"] == "revision"]
+        return str(revision.iloc[0]) if len(revision) else ""
+
+    def _build_member_index(self, infos):
+        """Map dataset name -> {'parts': [ZipInfo, ...], 'meta': bool, 'split': bool,
+        'size': int, 'compressed_size': int}.
+
+        Parquet datasets are stored 'unit split' as name/0, name/1... - those
+        get collected (in numerical order) into one entry.
+        The ZipInfos carry the member offsets (header_offset) and sizes.
+        """
+        parts = {}
+        for info in infos:
+            name = info.filename
+            m = None
+            if self.data_format == "parquet":
+                m = re.match("^(.+)/([0-9]+)$", name)
+            if m:
+                parts.setdefault(m.group(1), []).append((int(m.group(2)), info))
+            else:
+                parts.setdefault(name, []).append((None, info))
+        index = {}
+        for name, numbered in parts.items():
+            split = numbered[0][0] is not None
+            if split:
+                numbered = sorted(numbered, key=lambda x: x[0])
+            part_infos = [info for (_, info) in numbered]
+            index[name] = {
+                "parts": part_infos,
+                "meta": name.startswith("_") or os.path.basename(name).startswith("_"),
+                "split": split,
+                "size": sum(info.file_size for info in part_infos),
+                "compressed_size": sum(info.compress_size for info in part_infos),
+            }
+        return index
+
+    def _open_mmap(self):
+        """Memory map the zip file once, so stored members can be read without copying.
+        Returns None if that's not possible (e.g. we were passed a file like object)"""
+        import mmap
+
+        try:
+            with open(self.filename, "rb") as op:
+                return mmap.mmap(op.fileno(), 0, access=mmap.ACCESS_READ)
+        except (TypeError, ValueError, OSError):
+            return None
+
+    def _member_buffer(self, info):
+        """A zero-copy view on the bytes of an uncompressed member - or None
+        if the member is compressed (or encrypted) and needs to go through zipfile"""
+        if (
+            self._mmap is None
+            or info.compress_type != zipfile.ZIP_STORED
+            or info.flag_bits & 0x1
+        ):
+            return None
+        # the local header may have a different 'extra' than the central directory
+        header = self._mmap[info.header_offset : info.header_offset + 30]
+        if len(header) != 30 or header[:4] != b"PK\x03\x04":
+            return None
+        name_length, extra_length = struct.unpack("<HH", header[26:30])
+        start = info.header_offset + 30 + name_length + extra_length
+        return memoryview(self._mmap)[start : start + info.file_size]
 
     @property
     def tall(self):
@@ -91,8 +982,47 @@ class Biobank(object):
     def wide(self):
         return _BiobankItemAccessor(self.list_datasets, lambda dataset: self.get_wide(dataset, apply_exclusion=True))
 
+    @lazy_member("_cache_catalog")
+    def _catalog(self):
+        """The _meta/_catalog written by create_biobank - None for older files"""
+        import json
+
+        if "_meta/_catalog" not in self._members:
+            return None
+        with self.zf.open("_meta/_catalog") as op:
+            return json.loads(op.read().decode("utf-8"))
+
+    @cached_method
+    def get_dataset_summary(self, dataset):
+        """A dict describing @dataset:
+            rows, patients (count), variables (count), units,
+            compartment_columns, compartments (the distinct values of those),
+            comment, parquet_bytes, zip_bytes (stored size in the biobank file).
+        Read from the catalog - computed (once) for files that have none.
+        """
+        dataset = self.dataset_exists(dataset)
+        catalog = self._catalog()
+        if catalog is not None and dataset in catalog["datasets"]:
+            result = dict(catalog["datasets"][dataset])
+        else:
+            df = self.get_dataset(
+                dataset,
+                columns=["variable", "unit", "patient"] + known_compartment_columns,
+            )
+            result = summarize_dataset([df])
+            try:
+                result["comment"] = self.get_comment(dataset)
+            except KeyError:
+                result["comment"] = ""
+            result["parquet_bytes"] = self._members[dataset]["size"]
+        result["zip_bytes"] = self._members[dataset]["compressed_size"]
+        return result
+
     def get_all_patients(self):
-        df = self.get_dataset("_meta/patient_compartment_dataset")
+        catalog = self._catalog()
+        if catalog is not None:
+            return set(catalog["patients"])
+        df = self.get_dataset("_meta/patient_compartment_dataset", columns=["patient"])
         return set(df["patient"].unique())
 
     def number_of_patients(self):
@@ -108,34 +1038,62 @@ class Biobank(object):
         pcd = self.get_dataset("_meta/patient_compartment_dataset")
         return pcd
 
-    @lru_cache(datasets_to_cache)
+    @cached_method
     def get_dataset_compartments(self, dataset):
         """Get available compartments in dataset @dataset"""
-        ds = self.get_dataset(dataset)
         columns = self.get_dataset_compartment_columns(dataset)
         if not columns:
             return []
         else:
-            sub_ds = ds[columns]
+            sub_ds = self.get_dataset(dataset, columns=columns)
             sub_ds = sub_ds[~sub_ds.duplicated()]
             result = []
             for dummy_idx, row in sub_ds.iterrows():
                 result.append(tuple([row[x] for x in columns]))
             return set(result)
 
-    @lru_cache(datasets_to_cache)
+    @cached_method
     def get_dataset_compartment_columns(self, dataset):
         """Get available compartments columns in dataset @dataset"""
-        ds = self.get_dataset(dataset)
+        present = self._dataset_columns(dataset)
         columns = [
-            x for x in known_compartment_columns if x in ds.columns
+            x for x in known_compartment_columns if x in present
         ]  # compartment included for older datasets
         return columns
 
-    @lru_cache(datasets_to_cache)
+    def _parquet_metadata(self, info):
+        """The parquet footer (pyarrow FileMetaData) of the zip member @info.
+        Only the footer is parsed, and it's kept for the lifetime of the Biobank."""
+        import pyarrow
+        import pyarrow.parquet
+
+        result = self._footers.get(info.filename)
+        if result is None:
+            buffer = self._member_buffer(info)
+            if buffer is None:  # compressed - we need to inflate it anyway
+                buffer = self.zf.read(info)
+            result = pyarrow.parquet.read_metadata(
+                pyarrow.BufferReader(pyarrow.py_buffer(buffer))
+            )
+            self._footers[info.filename] = result
+        return result
+
+    def _dataset_columns(self, dataset):
+        """The column names of @dataset - from the schema of its first part if possible"""
+        dataset = self.dataset_exists(dataset)
+        if self.data_format == "parquet":
+            try:
+                metadata = self._parquet_metadata(self._members[dataset]["parts"][0])
+            except ImportError:
+                pass
+            else:
+                return metadata.schema.to_arrow_schema().names
+        return list(self.get_dataset(dataset).columns)
+
+    @cached_method
     def get_variables_and_units(self, dataset):
         """What variables are availabe in a dataset?"""
-        df = self.get_dataset(dataset)
+        df = self.get_dataset(dataset, columns=["variable", "unit"])
         if len(df["unit"].cat.categories) == 1:
             vars = df["variable"].unique()
             unit = df["unit"].iloc[0]
@@ -145,68 +1103,238 @@ class Biobank(object):
             return set(zip(x["variable"], x["unit"]))
 
     def get_possible_values(self, dataset, variable, unit):
-        df = self.get_dataset(dataset)
-        return df["value"][(df["variable"] == variable) & (df["unit"] == unit)].unique()
+        df = self.get_dataset(
+            dataset, columns=["value"], filters={"variable": variable, "unit": unit}
+        )
+        return df["value"].unique()
 
     @lazy_member("_cache_list_datasets")
     def list_datasets(self):
         """What datasets to we have"""
         if self.data_format == "msg_pack":
             return sorted(
-                [
-                    name
-                    for name in self.zf.namelist()
-                    if not name.startswith("_")
-                    and not os.path.basename(name).startswith("_")
-                ]
+                [name for (name, entry) in self._members.items() if not entry["meta"]]
             )
         elif self.data_format == "parquet":
             return sorted(
                 [
-                    name[: name.rfind("/")]
-                    for name in self.zf.namelist()
-                    if not name.startswith("_")
-                    and not os.path.basename(name[: name.rfind("/")]).startswith("_")
-                    and name.endswith("/0")
+                    name
+                    for (name, entry) in self._members.items()
+                    if not entry["meta"] and entry["split"]
                 ]
             )
 
     @lazy_member("_cache_list_datasets_incl_meta")
     def list_datasets_including_meta(self):
         """What datasets to we have"""
-        if self.data_format == "msg_pack":
-            return sorted(self.zf.namelist())
-        elif self.data_format == "parquet":
-            import re
+        return sorted(self._members)
+
+    @lazy_member("_cache_variable_index")
+    def _variable_index(self):
+        """(variable index DataFrame, {variable or name: [row positions]})"""
+        if "_meta/_variable_index" in self._members:
+            df = self.get_dataset("_meta/_variable_index")
+        else:  # older biobank file - build it (once), bypassing the cache
+            load_dataset = Biobank.get_dataset.__wrapped__
+            df = build_variable_index(
+                (ds, load_dataset(self, ds, columns=["variable", "name", "unit"]))
+                for ds in self.list_datasets()
+            )
+        positions = {}
+        for column in ["variable", "name"]:
+            codes, labels = _key_codes(df[column])
+            order = np.argsort(codes, kind="stable")
+            bounds = np.searchsorted(codes[order], np.arange(len(labels) + 1))
+            for ii, label in enumerate(labels):
+                hits = order[bounds[ii] : bounds[ii + 1]]
+                if label in positions:
+                    hits = np.union1d(positions[label], hits)
+                positions[label] = hits
+        return df, positions
+
+    def find_variable(self, query):
+        """Which datasets contain the variable (or name) @query (or any of a list of them)?
+
+        Answered from the variable index, without loading the datasets.
+        Returns a DataFrame (dataset, variable, name, unit, rows) - rows is the
+        number of (tall) rows of that variable in that dataset.
+        """
+        df, positions = self._variable_index()
+        if isinstance(query, str) or not hasattr(query, "__iter__"):
+            query = [query]
+        hits = [positions[x] for x in query if x in positions]
+        if hits:
+            hits = np.unique(np.concatenate(hits))
+        return df.iloc[hits].reset_index(drop=True)
+
+    def _dataset_footers(self, dataset):
+        dataset = self.dataset_exists(dataset)
+        if self.data_format != "parquet":
+            raise ValueError("Footers are only available for parquet biobank files")
+        return [self._parquet_metadata(info) for info in self._members[dataset]["parts"]]
+
+    def get_schema(self, dataset, categories=False):
+        """The columns of @dataset, from the parquet footers of all its parts
+        (no data is decoded). A DataFrame indexed by column, with
+            dtype - the pandas dtype ('category', 'float64', ...)
+            null_count, min, max - from the row group statistics (None if not recorded)
+            compressed_bytes, uncompressed_bytes - of the column's data
+
+        @categories adds the categories of the categorical columns - these are
+        not in the footers, so (only) those columns are loaded for it.
+        """
+        import json
 
-            raw = self.zf.namelist()
-            without_numbers = [
-                x if not re.search("/[0-9]+$", x) else x[: x.rfind("/")] for x in raw
+        stats = collections.OrderedDict()
+        for metadata in self._dataset_footers(dataset):
+            pandas_meta = json.loads((metadata.metadata or {}).get(b"pandas", b"{}"))
+            index_columns = set(
+                x for x in pandas_meta.get("index_columns", []) if isinstance(x, str)
+            )
+            dtypes = {}
+            for column in pandas_meta.get("columns", []):
+                dtypes[column["field_name"]] = (
+                    "category"
+                    if column["pandas_type"] == "categorical"
+                    else column["numpy_type"]
+                )
+            arrow_schema = metadata.schema.to_arrow_schema()
+            for ii in range(metadata.num_columns):
+                name = metadata.schema.column(ii).path
+                if name in index_columns:
+                    continue
+                if name not in stats:
+                    stats[name] = {
+                        "dtype": dtypes.get(name, str(arrow_schema.field(name).type)),
+                        "null_count": 0,
+                        "min": None,
+                        "max": None,
+                        "compressed_bytes": 0,
+                        "uncompressed_bytes": 0,
+                    }
+                entry = stats[name]
+                for rg in range(metadata.num_row_groups):
+                    chunk = metadata.row_group(rg).column(ii)
+                    entry["compressed_bytes"] += chunk.total_compressed_size
+                    entry["uncompressed_bytes"] += chunk.total_uncompressed_size
+                    statistics = chunk.statistics
+                    if statistics is None or entry["null_count"] is None:
+                        entry["null_count"] = None
+                    elif statistics.has_null_count:
+                        entry["null_count"] += statistics.null_count
+                    if statistics is not None and statistics.has_min_max:
+                        try:
+                            if entry["min"] is None or statistics.min < entry["min"]:
+                                entry["min"] = statistics.min
+                            if entry["max"] is None or statistics.max > entry["max"]:
+                                entry["max"] = statistics.max
+                        except TypeError:  # not comparable across parts
+                            pass
+        result = pd.DataFrame.from_dict(stats, orient="index")
+        result.index.name = "column"
+        if categories:
+            categorical = list(result.index[result["dtype"] == "category"])
+            df = self.get_dataset(dataset, columns=categorical)
+            result["categories"] = [
+                list(df[x].cat.categories) if x in categorical else None
+                for x in result.index
             ]
-            return sorted(set(without_numbers))
+        return result
+
+    def describe(self, dataset):
+        """Size and shape of @dataset, from the parquet footers of its parts
+        (no data is decoded). A dict with
+            parts, rows, rows_per_part, row_groups, columns,
+            zip_bytes (stored in the zip file), parquet_bytes (the parquet files),
+            uncompressed_bytes (the data, after parquet decompression)
+        """
+        dataset = self.dataset_exists(dataset)
+        footers = self._dataset_footers(dataset)
+        entry = self._members[dataset]
+        return {
+            "parts": len(footers),
+            "rows": sum(x.num_rows for x in footers),
+            "rows_per_part": [x.num_rows for x in footers],
+            "row_groups": sum(x.num_row_groups for x in footers),
+            "columns": list(self.get_schema(dataset).index),
+            "zip_bytes": entry["compressed_size"],
+            "parquet_bytes": entry["size"],
+            "uncompressed_bytes": sum(
+                x.row_group(rg).total_byte_size
+                for x in footers
+                for rg in range(x.num_row_groups)
+            ),
+        }
 
     @lazy_member("_datasets_with_name_lookup")
     def datasets_with_name_lookup(self):
-        return [ds for (ds, df) in self.iter_datasets() if "name" in df.columns]
+        return [ds for ds in self.list_datasets() if "name" in self._dataset_columns(ds)]
+
+    @cached_method
+    def _variable_lookup(self, dataset):
+        """Lookup tables for @dataset, built once from the distinct (variable, name, unit) rows:
+        {'names': {variable: name},
+         'keys': {variable or name: (variable, unit, [all variables it matches])}}.
+        The (variable, unit) is that of the first matching row.
+        """
+        df = self.get_dataset(dataset, columns=["variable", "name", "unit"])
+        has_name = "name" in df.columns
+        keys = ["variable", "name", "unit"] if has_name else ["variable", "unit"]
+        names = {}
+        lookup = {}
+        for row in _distinct_key_rows(df, keys):
+            if has_name:
+                variable, name, unit = row
+            else:
+                (variable, unit), name = row, np.nan
+            if pd.isnull(variable):
+                continue
+            if has_name and variable not in names:
+                names[variable] = name
+            for key in (variable, name):
+                if pd.isnull(key):
+                    continue
+                if key not in lookup:
+                    lookup[key] = (variable, unit, [variable])
+                elif variable not in lookup[key][2]:
+                    lookup[key][2].append(variable)
+        return {"names": names, "keys": lookup}
 
     def name_lookup(self, dataset, variable):
-        df = self.get_dataset(dataset)
-        # todo: optimize using where?
-        return df[df.variable == variable]["name"].iloc[0]
+        try:
+            return self._variable_lookup(dataset)["names"][variable]
+        except KeyError:
+            raise KeyError("Not found: %s" % (variable,))
+
+    def name_lookup_many(self, dataset, variables):
+        """name_lookup for a list of variables"""
+        names = self._variable_lookup(dataset)["names"]
+        missing = [x for x in variables if x not in names]
+        if missing:
+            raise KeyError("Not found: %s" % (missing,))
+        return [names[x] for x in variables]
 
     def variable_or_name_to_variable_and_unit(self, dataset, variable_or_name):
-        df = self.get_dataset(dataset)[["variable", "name", "unit"]]
-        rows = df[(df.variable == variable_or_name) | (df.name == variable_or_name)]
-        if len(rows["variable"].unique()) > 1:
-            raise ValueError(
-                "variable_or_name_to_variable led to multiple variables (%i): %s"
-                % (len(rows["variable"].unique()), rows["variable"].unique())
-            )
-        try:
-            r = rows.iloc[0]
-        except IndexError:
-            raise KeyError("Not found: %s" % variable_or_name)
-        return r["variable"], r["unit"]
+        return self.variable_or_name_to_variable_and_unit_many(
+            dataset, [variable_or_name]
+        )[0]
+
+    def variable_or_name_to_variable_and_unit_many(self, dataset, variables_or_names):
+        """variable_or_name_to_variable_and_unit for a list of variables / names"""
+        lookup = self._variable_lookup(dataset)["keys"]
+        result = []
+        for variable_or_name in variables_or_names:
+            try:
+                variable, unit, variables = lookup[variable_or_name]
+            except KeyError:
+                raise KeyError("Not found: %s" % variable_or_name)
+            if len(variables) > 1:
+                raise ValueError(
+                    "variable_or_name_to_variable led to multiple variables (%i): %s"
+                    % (len(variables), variables)
+                )
+            result.append((variable, unit))
+        return result
 
     def _get_dataset_columns_meta(self):
         import json
@@ -225,7 +1353,6 @@ class Biobank(object):
             return False
         return True
 
-    @lru_cache(maxsize=datasets_to_cache)
     def get_wide(
         self,
         dataset,
@@ -233,6 +1360,12 @@ class Biobank(object):
         standardized=False,
         filter_func=None,
         column="value",
+        filters=None,
+        sparse=False,
+        dtype=None,
+        variables=None,
+        patients=None,
+        **compartment_filters
     ):
         """Return dataset in row=variable, column=patient format.
         if @standardized is True Index is always (variable, unit) or (variable, unit, name), 
@@ -245,23 +1378,136 @@ class Biobank(object):
          @filter_func is run on the dataset before converting to wide, it
          takes a df, returns a modified df
 
+         @filters is a {column: value or [values]} dict that is pushed
+         down into the parquet reader - see get_dataset
+
+         @sparse returns pandas SparseDtype columns (missing values are not stored),
+         built directly from the tall data
+
+         @dtype, e.g. np.float32, is the type the values are written as
+         (instead of float64) - the cache holds the reduced precision result
+
+         @variables restricts the rows to these variables (or names, like
+         variable_or_name_to_variable_and_unit) - only their tall rows are read.
+
+         @patients and compartment column keywords (e.g. cell_type='tumor')
+         restrict the columns - applied to the tall data before pivoting.
+
+         With the default arguments, a wide DataFrame precomputed by
+         create_biobank(store_wide=True) is loaded instead of pivoting.
+
         """
+        method, args = self._wide_call(
+            dataset,
+            apply_exclusion,
+            standardized,
+            filter_func,
+            column,
+            filters,
+            sparse,
+            dtype,
+            variables,
+            patients,
+            **compartment_filters
+        )
+        return method(self, *args)
+
+    def _wide_call(
+        self,
+        dataset,
+        apply_exclusion=True,
+        standardized=False,
+        filter_func=None,
+        column="value",
+        filters=None,
+        sparse=False,
+        dtype=None,
+        variables=None,
+        patients=None,
+        **compartment_filters
+    ):
+        """Normalize get_wide's arguments.
+        Returns the (cached) method that produces the result, and its arguments"""
         dataset = self.dataset_exists(dataset)
         if not self.has_wide(dataset):
             raise WideNotSupported()
-        df = self.get_dataset(dataset)
+        for key in compartment_filters:
+            if key not in known_compartment_columns:
+                raise TypeError("get_wide() got an unexpected keyword argument %s" % key)
+        filters = normalize_filters(filters)
+        if patients is not None:
+            compartment_filters["patient"] = patients
+        filters = merge_filters(filters, normalize_filters(compartment_filters))
+        if variables is not None:
+            filters = merge_filters(
+                filters,
+                normalize_filters(
+                    {"variable": self._resolve_variables(dataset, variables)}
+                ),
+            )
+        if dtype is not None:
+            # np.float32, 'float32' and np.dtype('float32') share one cache entry -
+            # and a type (being callable) would keep it out of the disk cache
+            dtype = np.dtype(dtype).name
+        if (
+            dataset in self._stored_wide
+            and apply_exclusion
+            and not standardized
+            and filter_func is None
+            and column == "value"
+            and not filters
+            and not sparse
+            and dtype is None
+        ):
+            return Biobank._get_stored_wide, (dataset,)
+        return (
+            Biobank._get_wide,
+            (
+                dataset,
+                apply_exclusion,
+                standardized,
+                filter_func,
+                column,
+                filters,
+                sparse,
+                dtype,
+            ),
+        )
+
+    @cached_method(on_disk=True)
+    def _get_wide(
+        self,
+        dataset,
+        apply_exclusion,
+        standardized,
+        filter_func,
+        column,
+        filters,
+        sparse,
+        dtype,
+    ):
+        """get_wide with normalized arguments (which make up the cache key)"""
         if filter_func:
-            df = filter_func(df)
+            df = filter_func(self.get_dataset(dataset, filters=filters))
+            layout_df = df
+        else:
+            df = self.get_dataset(
+                dataset,
+                columns=self._wide_source_columns(dataset, column),
+                filters=filters,
+            )
+            # the wide layout (unit in index?, which compartment columns)
+            # is that of the complete dataset, not of the subset
+            layout_df = self._wide_layout_frame(dataset) if filters else df
 
-        index = ["variable"]
-        columns = self._get_wide_columns(dataset, df, standardized)
-        if standardized or len(df.unit.cat.categories) > 1:
-            index.append("unit")
-        if "name" in df.columns:
-            index.append("name")
+        index, columns = self._wide_layout(
+            dataset, layout_df, standardized, "name" in df.columns
+        )
         # if 'somascan' in dataset:
         # raise ValueError(dataset, df.columns, index ,columns)
-        dfw = self.to_wide(df, index, columns, column=column)
+        dfw = self.to_wide(
+            df, index, columns, column=column, sparse=sparse, dtype=dtype
+        )
         if apply_exclusion:
             try:
                 return self.apply_exclusion(dataset, dfw)
@@ -270,6 +1516,284 @@ class Biobank(object):
         else:
             return dfw
 
+    @cached_method
+    def _get_stored_wide(self, dataset):
+        """The get_wide(dataset) result create_biobank(store_wide=True) precomputed"""
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            return self._get_wide(dataset, True, False, None, "value", None, False, None)
+        info = self._stored_wide[dataset]
+        buffer = self._member_buffer(info)
+        if buffer is None:
+            buffer = self.zf.read(info)
+        return _table_to_frame(pyarrow.parquet.read_table(pyarrow.py_buffer(buffer)))
+
+    def _wide_layout_frame(self, dataset):
+        """A stand-in for the key columns of the complete @dataset, for _wide_layout:
+        its units and distinct compartments, from the catalog (and which
+        columns there are, from the footers) - no rows are decoded.
+        Files without catalog load the key columns instead."""
+        catalog = self._catalog()
+        if (
+            catalog is None
+            or dataset not in catalog["datasets"]
+            or self.data_format != "parquet"
+        ):
+            return self.get_dataset(dataset, columns=self._wide_key_columns(dataset))
+        summary = catalog["datasets"][dataset]
+        compartments = summary["compartments"]
+        rows = max(len(compartments), 1)
+        result = {
+            "unit": pd.Categorical.from_codes(
+                np.full(rows, -1), categories=summary["units"]
+            )
+        }
+        for ii, x in enumerate(summary["compartment_columns"]):
+            result[x] = [row[ii] for row in compartments] or [None]
+        present = self._dataset_columns(dataset)
+        for x in ["patient", "vid"]:
+            if x in present:
+                result[x] = np.nan
+        return pd.DataFrame(result)
+
+    def _wide_layout(self, dataset, layout_df, standardized, has_name):
+        """(index, columns) to pivot @dataset on"""
+        index = ["variable"]
+        columns = self._get_wide_columns(dataset, layout_df, standardized)
+        if standardized or len(layout_df.unit.cat.categories) > 1:
+            index.append("unit")
+        if has_name:
+            index.append("name")
+        return index, columns
+
+    def iter_wide(
+        self,
+        dataset,
+        chunk_variables=5000,
+        apply_exclusion=True,
+        standardized=False,
+        column="value",
+        dtype=None,
+    ):
+        """get_wide(dataset) in pieces of at most @chunk_variables variables (rows).
+
+        Only the tall rows of the current chunk are read & pivoted, and neither
+        the chunks nor the columns read to lay them out are cached -
+        for datasets whose wide form does not fit into memory.
+        All chunks share the same column index, so pd.concat(iter_wide(...))
+        equals get_wide(...) (for mixed type values, to_wide's per column
+        float conversion may turn out differently per chunk).
+        """
+        dataset = self.dataset_exists(dataset)
+        if not self.has_wide(dataset):
+            raise WideNotSupported()
+        if chunk_variables < 1:
+            raise ValueError("chunk_variables must be >= 1")
+        # bypass the cache - neither these full columns nor the chunks
+        # should stay around (or push out everything else)
+        load_dataset = Biobank.get_dataset.__wrapped__
+        variable_df = load_dataset(self, dataset, columns=["variable", "name"])
+        variable = variable_df["variable"]
+        if isinstance(variable.dtype, pd.CategoricalDtype):
+            # category order is the order get_wide's rows are in
+            variables = list(variable.cat.remove_unused_categories().cat.categories)
+        else:
+            variables = sorted(variable.dropna().unique())
+        layout_df = load_dataset(
+            self, dataset, columns=self._wide_key_columns(dataset)
+        )
+        index, columns = self._wide_layout(
+            dataset, layout_df, standardized, "name" in variable_df.columns
+        )
+        column_index = _wide_column_index(layout_df, columns)
+        # the complete dataset's categories - a chunk of unit split parts
+        # would otherwise get only the ones it uses
+        row_dtypes = {
+            key: source[key].dtype
+            for (key, source) in [
+                ("variable", variable_df),
+                ("name", variable_df),
+                ("unit", layout_df),
+            ]
+            if key in source.columns
+            and isinstance(source[key].dtype, pd.CategoricalDtype)
+        }
+        for start in range(0, len(variables), chunk_variables):
+            df = load_dataset(
+                self,
+                dataset,
+                columns=self._wide_source_columns(dataset, column),
+                filters={"variable": variables[start : start + chunk_variables]},
+            )
+            df = df.astype({k: v for (k, v) in row_dtypes.items() if k in df.columns})
+            dfw = self.to_wide(df, index, columns, column=column, dtype=dtype)
+            dfw = dfw.reindex(columns=column_index)
+            if dtype is not None:  # the columns reindex added are float64
+                dfw = dfw.astype(
+                    {
+                        c: dtype
+                        for (c, dt) in zip(dfw.columns, dfw.dtypes)
+                        if pd.api.types.is_float_dtype(dt)
+                    }
+                )
+            if apply_exclusion:
+                try:
+                    dfw = self.apply_exclusion(dataset, dfw)
+                except CantApplyExclusion:
+                    pass
+            yield dfw
+
+    def get_wide_multi(self, datasets, join="inner", stack=False, **get_wide_kwargs):
+        """get_wide() for several datasets, aligned on one shared column index.
+
+        The datasets are pivoted in parallel (always standardized=True,
+        other keyword arguments are passed on to get_wide). Their column levels
+        are brought into one order (missing levels become NaN), and one column
+        index is built from the union (@join='outer') or intersection
+        (@join='inner') of the (patient, compartment, ...) keys.
+
+        Patient level datasets (e.g. clinical - no compartment information) are
+        broadcast: their patient's values appear in every compartment column
+        of that patient. With 'inner', only patients they contain are kept.
+
+        Returns an OrderedDict dataset -> DataFrame, or, with @stack,
+        one DataFrame with an additional 'dataset' row index level.
+        """
+        if join not in ("inner", "outer"):
+            raise ValueError("join must be 'inner' or 'outer', was %s" % (join,))
+        if not get_wide_kwargs.get("standardized", True):
+            raise ValueError("get_wide_multi needs standardized=True to align columns")
+        if isinstance(datasets, str):
+            datasets = [datasets]
+        datasets = [self.dataset_exists(ds) for ds in datasets]
+        duplicates = sorted(set(ds for ds in datasets if datasets.count(ds) > 1))
+        if duplicates:
+            raise ValueError("Datasets requested more than once: %s" % (duplicates,))
+        get_wide_kwargs["standardized"] = True
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(
+            max(1, min(len(datasets), background_threads))
+        ) as pool:
+            frames = list(
+                pool.map(lambda ds: self.get_wide(ds, **get_wide_kwargs), datasets)
+            )
+
+        level_order = ["patient", "vid"] + known_compartment_columns
+        names = []
+        for df in frames:
+            for name in df.columns.names:
+                if name not in names:
+                    names.append(name)
+        names = sorted(
+            names,
+            key=lambda x: (level_order.index(x), "")
+            if x in level_order
+            else (len(level_order), str(x)),
+        )
+
+        def normalize_columns(columns):
+            present = list(columns.names)
+            return pd.MultiIndex.from_arrays(
+                [
+                    columns.get_level_values(name)
+                    if name in present
+                    else np.full(len(columns), np.nan)
+                    for name in names
+                ],
+                names=names,
+            )
+
+        def is_patient_level(columns):
+            return all(
+                columns.get_level_values(name).isnull().all()
+                for name in names
+                if name != "patient"
+            )
+
+        column_indices = [normalize_columns(df.columns) for df in frames]
+        patient_level = [is_patient_level(columns) for columns in column_indices]
+        combine = (
+            (lambda a, b: a.union(b))
+            if join == "outer"
+            else (lambda a, b: a.intersection(b))
+        )
+        compartment_indices = [
+            columns
+            for (columns, broadcast) in zip(column_indices, patient_level)
+            if not broadcast
+        ]
+        patient_indices = [
+            columns.get_level_values("patient")
+            for (columns, broadcast) in zip(column_indices, patient_level)
+            if broadcast
+        ]
+        if not compartment_indices:  # nothing to broadcast onto
+            shared = functools.reduce(combine, column_indices)
+        else:
+            shared = functools.reduce(combine, compartment_indices)
+            if patient_indices:
+                patients = functools.reduce(combine, patient_indices)
+                if join == "inner":
+                    shared = shared[shared.get_level_values("patient").isin(patients)]
+                else:
+                    covered = shared.get_level_values("patient")
+                    extra = patients[~patients.isin(covered)]
+                    shared = shared.union(
+                        normalize_columns(pd.MultiIndex.from_arrays([extra], names=["patient"]))
+                    )
+        result = collections.OrderedDict()
+        for dataset, df, columns, broadcast in zip(
+            datasets, frames, column_indices, patient_level
+        ):
+            if broadcast and compartment_indices:
+                df = df.set_axis(columns.get_level_values("patient"), axis=1)
+                df = df.reindex(columns=shared.get_level_values("patient"))
+                result[dataset] = df.set_axis(shared, axis=1)
+            else:
+                df = df.set_axis(columns, axis=1)
+                result[dataset] = df.reindex(columns=shared)
+        if stack:
+            to_stack = []
+            for df in result.values():
+                if "name" not in df.index.names:
+                    df = df.set_index(
+                        pd.Index(np.full(len(df), np.nan), name="name"), append=True
+                    )
+                to_stack.append(df)
+            return pd.concat(to_stack, keys=list(result.keys()), names=["dataset"])
+        return result
+
+    def _wide_source_columns(self, dataset, column="value"):
+        """The (tall) columns get_wide might need"""
+        return [column, "variable", "name"] + self._wide_key_columns(dataset)
+
+    def _wide_key_columns(self, dataset):
+        """The (tall) columns that decide get_wide's layout -
+        including whatever _to_wide_columns pivots @dataset on"""
+        try:
+            pivot_columns = self._get_dataset_columns_meta().get(dataset, [])
+        except KeyError:
+            pivot_columns = []
+        result = ["unit", "patient", "vid"] + known_compartment_columns
+        return result + [x for x in pivot_columns if x not in result]
+
+    def _resolve_variables(self, dataset, variables_or_names):
+        """Map variables or names to the variables of @dataset.
+        A name shared by several variables selects all of them"""
+        if isinstance(variables_or_names, str):
+            variables_or_names = [variables_or_names]
+        lookup = self._variable_lookup(dataset)["keys"]
+        missing = set(x for x in variables_or_names if x not in lookup)
+        if missing:
+            raise KeyError("Not found: %s" % (sorted(missing),))
+        result = set()
+        for x in variables_or_names:
+            result.update(lookup[x][2])
+        return sorted(result)
+
     def _get_wide_columns(self, dataset, tall_df, standardized):
         try:
             columns_to_use = self._get_dataset_columns_meta()
@@ -333,6 +1857,8 @@ class Biobank(object):
         columns=known_compartment_columns,
         sort_on_first_level=False,
         column='value',
+        sparse=False,
+        dtype=None,
     ):
         """Convert a dataset (or filtered dataset) to a wide DataFrame.
         Preferred to pd.pivot_table manually because it is
@@ -342,7 +1868,12 @@ class Biobank(object):
 
         index = variable,unit
         columns = (patient, compartment, cell_type)
+
+        With @sparse, the columns are pandas SparseDtype (fill value NaN).
+        @dtype (e.g. np.float32) is used for the numeric values instead of float64.
         """
+        if dtype is not None and np.dtype(dtype).kind != "f":
+            raise ValueError("dtype must be a floating point type, was %s" % (dtype,))
         if columns == known_compartment_columns:
             columns = [x for x in columns if x in df.columns]
         # raise ValueError(df.columns,index,columns)
@@ -351,6 +1882,32 @@ class Biobank(object):
         for x in chosen:
             if x not in df.columns:
                 df = df.assign(**{x: np.nan})
+        res = _pivot_by_codes(df, index, columns, column, sparse=sparse, dtype=dtype)
+        if res is None:  # mixed types - let pandas do it
+            res = self._to_wide_unstack(df, index, columns, column)
+            if dtype is not None:
+                res = res.astype(
+                    {
+                        c: dtype
+                        for (c, dt) in zip(res.columns, res.dtypes)
+                        if pd.api.types.is_float_dtype(dt)
+                    }
+                )
+            if sparse:
+                res = pd.DataFrame(
+                    {
+                        ii: pd.arrays.SparseArray(res[c], fill_value=np.nan)
+                        for (ii, c) in enumerate(res.columns)
+                    },
+                    index=res.index,
+                ).set_axis(res.columns, axis=1)
+        if sort_on_first_level:
+            # sort on first level - ie. patient, not compartment - slow though
+            res = res[sorted(list(res.columns))]
+        return res
+
+    def _to_wide_unstack(self, df, index, columns, column):
+        """The set_index/unstack to_wide - for non numeric values"""
         set_index_on = index + columns
         columns_pos = tuple(range(len(index), len(index) + len(columns)))
         res = df.set_index(set_index_on).unstack(columns_pos)
@@ -373,9 +1930,6 @@ class Biobank(object):
         single_unit = not 'unit' in df.columns or len(df['unit'].unique()) == 1
         if isinstance(c, list):
             res.columns.names = columns
-        if sort_on_first_level:
-            # sort on first level - ie. patient, not compartment - slow though
-            res = res[sorted(list(res.columns))]
         for c in res.columns:
             x = res[c].fillna(value=np.nan, inplace=False)
             if (x == None).any():  # noqa: E711
@@ -387,7 +1941,6 @@ class Biobank(object):
                     pass
         return res
 
-    @lru_cache(maxsize=datasets_to_cache)
     def get_excluded_patients(self, dataset):
         """Which patients are excluded from this particular dataset (or globally)?.
 
@@ -395,71 +1948,67 @@ class Biobank(object):
         certain compartments where excluded.
 
         """
+        patients, partial = self._dataset_exclusion(dataset)
+        excluded = set(patients)
+        excluded.update(
+            tuple(zip(partial.columns, row))
+            for row in partial.itertuples(index=False, name=None)
+        )
+        return excluded
+
+    @lazy_member("_cache_global_exclusion")
+    def _global_exclusion(self):
+        """pd.Index of the patients excluded from all datasets"""
         try:
-            global_exclusion_df = self.get_dataset("clinical/_other_exclusion")
-            excluded = set(global_exclusion_df["patient"].unique())
+            df = self.get_dataset("clinical/_other_exclusion", columns=["patient"])
         except KeyError:
-            excluded = set()
-        # local exclusion from this dataset
+            return pd.Index([], dtype=object)
+        return pd.Index(df["patient"].unique(), dtype=object)
+
+    def _exclusion_dataset_name(self, dataset):
+        return (
+            os.path.dirname(dataset) + "/" + "_" + os.path.basename(dataset) + "_exclusion"
+        )
+
+    @cached_method
+    def _dataset_exclusion(self, dataset):
+        """(patients, partial) excluded from @dataset.
+
+        patients is a pd.Index (including the global exclusion),
+        partial a DataFrame of (patient, compartment columns...) rows
+        for patients where only certain compartments were excluded.
+        """
+        patients = self._global_exclusion()
+        partial = pd.DataFrame({"patient": []}, dtype=object)
         try:
-            exclusion_path = (
-                os.path.dirname(dataset)
-                + "/"
-                + "_"
-                + os.path.basename(dataset)
-                + "_exclusion"
-            )
-            exclusion_df = self.get_dataset(exclusion_path)
+            exclusion_df = self.get_dataset(self._exclusion_dataset_name(dataset))
         except KeyError:
-            return excluded
+            return patients, partial
         columns = ["patient"] + self.get_dataset_compartment_columns(dataset)
         columns = [x for x in columns if x in exclusion_df.columns]
-        res = exclusion_df[columns]
-        if set(res.columns) == set(["patient"]):
-            excluded.update(exclusion_df["patient"].unique())
+        if columns == ["patient"]:
+            patients = patients.append(
+                pd.Index(exclusion_df["patient"].unique(), dtype=object)
+            ).unique()
         else:
-            for idx, row in exclusion_df.iterrows():
-                d = []
-                for c in columns:
-                    d.append((c, row[c]))
-                excluded.add(tuple(d))
-        return excluded
+            partial = (
+                exclusion_df[columns].astype(object).drop_duplicates().reset_index(drop=True)
+            )
+        return patients, partial
 
     def apply_exclusion(self, dataset_name, df):
         dataset_name = self.dataset_exists(dataset_name)
-        excluded = self.get_excluded_patients(dataset_name)
-        # columns = ["patient"] + self.get_dataset_compartment_columns(dataset_name)
+        patients, partial = self._dataset_exclusion(dataset_name)
         if "patient" in df.columns:  # a tall dataset
-            keep = np.ones((len(df),), np.bool)
-            for x in excluded:
-                if isinstance(x, tuple):
-                    matching = np.ones((len(df),), np.bool)
-                    for column, value in x:
-                        matching &= df[column] == value
-                    keep = keep & ~matching
-                else:
-                    keep = keep & ~(df["patient"] == x)
-            return df[keep]
+            return df[~_excluded_rows(df, patients, partial)]
         elif df.index.names[0] == "variable":  # a wide dataset...
-            to_remove = []
-            for c in df.columns:
-                if isinstance(c, tuple):
-                    if c[0] in excluded:  # patient totaly excluded
-                        to_remove.append(c)
-                    else:
-                        key = tuple(zip(df.columns.names, c))
-                        if key in excluded:
-                            to_remove.append(c)
-                else:
-                    if c in excluded:
-                        to_remove.append(c)
-            return df.drop(to_remove, axis=1)
+            return df.loc[:, ~_excluded_columns(df.columns, patients, partial)]
         else:
             raise CantApplyExclusion(
                 "Sorry, not a tall or wide DataFrame that I know how to handle."
             )
 
-    @lru_cache(maxsize=1)
+    @cached_method
     def get_exclusion_reasons(self):
         """Get exclusion information for all the datasets + globally"""
         result = {}
@@ -470,13 +2019,7 @@ class Biobank(object):
             result[tup.patient]["global"] = tup.reason
         for dataset in self.list_datasets():
             try:
-                exclusion_df = self.get_dataset(
-                    os.path.dirname(dataset)
-                    + "/"
-                    + "_"
-                    + os.path.basename(dataset)
-                    + "_exclusion"
-                )
+                exclusion_df = self.get_dataset(self._exclusion_dataset_name(dataset))
                 for tup in exclusion_df.itertuples():
                     if tup.patient not in result:
                         result[tup.patient] = {}
@@ -494,7 +2037,7 @@ class Biobank(object):
             yield name, self.get_dataset(name)
 
     def dataset_exists(self, name):
-        datasets = self.list_datasets_including_meta()
+        datasets = self._members
         out = False
         if name in datasets:
             out = name
@@ -512,21 +2055,71 @@ class Biobank(object):
             import difflib
 
             msg += "Suggestions: "
-            for x in difflib.get_close_matches(name, datasets):
+            for x in difflib.get_close_matches(
+                name, self.list_datasets_including_meta()
+            ):
                 msg += " " + x + " "
             msg += ". Use .list_datasets() to view all datasets"
             raise KeyError(msg)
         return out
 
-    def __load_df_from_parquet(self, name):
+    def __load_df_from_parquet(self, name, columns=None, filters=None):
+        """@name may be a member name or a ZipInfo.
+        @columns: None for all, or a list - columns not in the parquet are ignored
+        @filters: normalized filters (see normalize_filters) - pushed down
+        into pyarrow so that row groups can be skipped"""
         try:
             import pyarrow
         except ImportError:
+            pyarrow = None
             try:
                 import fastparquet
             except ImportError:
                 raise ValueError("marburg_biobank needs either pyarrow or fastparquet")
 
+        if pyarrow is not None:
+            import pyarrow.parquet
+
+            info = name if isinstance(name, zipfile.ZipInfo) else self.zf.getinfo(name)
+            buffer = self._member_buffer(info)
+            if buffer is None:  # compressed - we need to inflate it anyway
+                buffer = self.zf.read(info)
+            source = pyarrow.py_buffer(buffer)
+            if columns is not None or filters:
+                schema = pyarrow.parquet.read_schema(source)
+                present = set(schema.names)
+            if columns is not None:
+                columns = [x for x in columns if x in present]
+            if not filters:
+                filters = None
+            else:
+                import pyarrow.compute
+
+                expression = None
+                for column, values in filters:
+                    if column not in present:
+                        raise ValueError(
+                            "Can not filter on %s - not in dataset" % column
+                        )
+                    condition = pyarrow.compute.field(column).isin(
+                        _arrow_filter_values(schema.field(column).type, values)
+                    )
+                    expression = (
+                        condition if expression is None else expression & condition
+                    )
+                filters = expression
+            return pyarrow.parquet.read_table(
+                source,
+                columns=columns,
+                filters=filters,
+                use_pandas_metadata=True,
+            ).to_pandas()
+        df = filter_df(self.__load_df_from_parquet_fallback(name), filters)
+        if columns is not None:
+            df = df[[x for x in columns if x in df.columns]]
+        return df
+
+    def __load_df_from_parquet_fallback(self, name):
         try:
             with self.zf.open(name) as op:
                 return pd.read_parquet(op)
@@ -554,10 +2147,27 @@ class Biobank(object):
                 raise
         raise NotImplementedError()
 
-    @lru_cache(datasets_to_cache)
-    def get_dataset(self, name, apply_exclusion=False):
-        """Retrieve a dataset"""
+    @cached_method(on_disk=True)
+    def get_dataset(self, name, apply_exclusion=False, columns=None, filters=None):
+        """Retrieve a dataset.
+
+        @columns may be a list of columns to load - the others are never decoded.
+        Columns that the dataset does not have are ignored.
+
+        @filters may be a dict of {column: value or [values]} on variable, unit,
+        patient or the compartment columns. Only matching rows are returned,
+        and (with pyarrow) row groups that can not match are never read.
+        """
         name = self.dataset_exists(name)
+        if columns is not None:
+            columns = tuple(columns)
+        filters = normalize_filters(filters)
+        load_columns = columns
+        if apply_exclusion and columns is not None:
+            # exclusion needs patient & compartment information
+            load_columns = columns + tuple(
+                x for x in ["patient"] + known_compartment_columns if x not in columns
+            )
         if self.data_format == "msg_pack":
             try:
                 import mbf_pandas_msgpack
@@ -571,6 +2181,9 @@ class Biobank(object):
                         raise ValueError(
                             "Your pandas is too old. You need at least version 0.18"
                         )
+            df = filter_df(df, filters)
+            if load_columns is not None:
+                df = df[[x for x in load_columns if x in df.columns]]
         elif self.data_format == "parquet":
             try:
                 import pyarrow
@@ -580,28 +2193,24 @@ class Biobank(object):
                 except ImportError:
                     raise ValueError("marburg_biobank needs either pyarrow or fastparquet")
 
-            ds = self.zf.namelist()
-            ii = 0
-            dfs = []
-            sub_name = name + "/" + str(ii)
-            while sub_name in ds:
-                dfs.append(self.__load_df_from_parquet(sub_name))
-                ii += 1
-                sub_name = name + "/" + str(ii)
-            if not dfs:  # not actually a unit splitted dataframe - meta?
-                df = self.__load_df_from_parquet(name)
-            elif len(dfs) == 1:
-                df = dfs[0]
+            parts = self._members[name]["parts"]
+            if len(parts) == 1:
+                df = self.__load_df_from_parquet(parts[0], load_columns, filters)
             else:
-                categoricals = set()
-                for df in dfs:
-                    for c, dt in df.dtypes.items():
-                        if dt.name == "category":
-                            categoricals.add(c)
-                df = pd.concat(dfs)
-                reps = {c: pd.Categorical(df[c]) for c in categoricals}
-                if reps:
-                    df = df.assign(**reps)
+                # parquet decoding releases the GIL
+                from concurrent.futures import ThreadPoolExecutor
+
+                threads = min(len(parts), part_loading_threads or os.cpu_count() or 1)
+                with ThreadPoolExecutor(threads) as pool:
+                    dfs = list(
+                        pool.map(
+                            lambda info: self.__load_df_from_parquet(
+                                info, load_columns, filters
+                            ),
+                            parts,
+                        )
+                    )
+                df = _concat_parts(dfs)
         else:
             raise ValueError(
                 "Unexpected data format. Do you need to upgrade marburg_biobank?"
@@ -610,10 +2219,15 @@ class Biobank(object):
             try:
                 df = self.apply_exclusion(name, df)
             except CantApplyExclusion:
-                return df
+                pass
+            if load_columns is not columns:
+                df = df[[x for x in columns if x in df.columns]]
         return df
 
     def get_comment(self, name):
+        catalog = self._catalog()
+        if catalog is not None and "comments" in catalog:
+            return catalog["comments"].get(name, "")
         comments = self.get_dataset("_meta/comments")
         if len(comments) == 0:
             return ""
@@ -705,6 +2319,34 @@ def download_and_open(username=False, password=False, revision=None, biobank='ov
     return Biobank(fn)
 
 
+class PrefetchHandle(object):
+    """Returned by Biobank.prefetch()"""
+
+    def __init__(self, futures):
+        self.futures = futures  # dataset -> concurrent.futures.Future
+
+    def done(self):
+        """Has every dataset been loaded (or failed)?"""
+        return all(f.done() for f in self.futures.values())
+
+    def wait(self, timeout=None):
+        """Block until all datasets are loaded. Reraises the first exception"""
+        import concurrent.futures
+
+        _done, not_done = concurrent.futures.wait(
+            list(self.futures.values()), timeout=timeout
+        )
+        if not_done:
+            raise concurrent.futures.TimeoutError()
+        for f in self.futures.values():
+            f.result()
+
+    def cancel(self):
+        """Cancel the loads that have not started yet"""
+        for f in self.futures.values():
+            f.cancel()
+
+
 class _BiobankItemAccessor:
     def __init__(self, list_callback, get_callback):
         self.list_callback = list_callback
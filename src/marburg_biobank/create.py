@@ -10,7 +10,7 @@ import zipfile
 import os
 import json
 import base64
-from . import WideNotSupported
+from . import WideNotSupported, build_variable_index
 
 
 settings = None
@@ -279,9 +279,58 @@ def extract_patient_compartment_meta(dict_of_dfs):
     return pd.DataFrame(output)
 
 
-def create_biobank(dict_of_dataframes, name, revision, filename, to_wide_columns):
+def dataset_parts(dict_of_dfs):
+    """{dataset: [names of its (unit split) parts]} - for the non meta datasets"""
+    result = {}
+    for name in dict_of_dfs:
+        if re.search("/[0-9]+$", name):
+            dataset = name[: name.rfind("/")]
+            if not dataset.startswith("_") and not os.path.basename(dataset).startswith(
+                "_"
+            ):
+                result.setdefault(dataset, []).append(name)
+    return result
+
+
+def build_catalog(dict_of_dfs, sizes):
+    """The _meta/_catalog: a summary of every dataset (see Biobank.get_dataset_summary),
+    all patients (as in _meta/patient_compartment_dataset) and the comments.
+    @sizes is {member name: parquet bytes}"""
+    from . import summarize_dataset
+
+    comments = {}
+    if "_meta/comments" in dict_of_dfs:
+        df = dict_of_dfs["_meta/comments"]
+        if len(df):
+            df = df.drop_duplicates("path")
+            comments = dict(zip(df["path"], df["comment"]))
+    datasets = {}
+    for dataset, names in dataset_parts(dict_of_dfs).items():
+        entry = summarize_dataset([dict_of_dfs[name] for name in names])
+        entry["comment"] = comments.get(dataset, "")
+        entry["parquet_bytes"] = sum(sizes[name] for name in names)
+        datasets[dataset] = entry
+    pcd = dict_of_dfs["_meta/patient_compartment_dataset"]
+    result = {
+        "datasets": datasets,
+        "patients": sorted(pcd["patient"].dropna().unique())
+        if "patient" in pcd.columns
+        else [],
+    }
+    if "_meta/comments" in dict_of_dfs:
+        result["comments"] = comments
+    return result
+
+
+def create_biobank(
+    dict_of_dataframes, name, revision, filename, to_wide_columns, store_wide=False
+):
     """Create a file suitable for biobank consumption.
     Assumes all dataframes pass check_dataframe
+
+    With @store_wide, the default get_wide(dataset) (apply_exclusion=True,
+    standardized=False) of every dataset is stored as well (_wide/<dataset>),
+    so readers load it instead of pivoting.
     """
     if settings is None:
         raise ValueError("Must call apply_*_settings (eg. apply_ovca_settings) first")
@@ -313,14 +362,30 @@ def create_biobank(dict_of_dataframes, name, revision, filename, to_wide_columns
         "_meta/patient_compartment_dataset"
     ] = extract_patient_compartment_meta(dict_of_dataframes)
     print("patient_compartment_dataset_time", time.time() - s)
+    s = time.time()
+    dict_of_dataframes["_meta/_variable_index"] = build_variable_index(
+        (dataset, dict_of_dataframes[name])
+        for (dataset, names) in dataset_parts(dict_of_dataframes).items()
+        for name in names
+    )
+    print("variable_index_time", time.time() - s)
     print("now writing zip file")
     zfs = zipfile.ZipFile(filename, "w")
+    sizes = {}
     for name, df in dict_of_dataframes.items():
         tf = tempfile.NamedTemporaryFile(mode="w+b", suffix=".pq")
         df.to_parquet(tf)
         tf.flush()
         tf.seek(0, 0)
-        zfs.writestr(name, tf.read())
+        data = tf.read()
+        sizes[name] = len(data)
+        zfs.writestr(name, data)
+    s = time.time()
+    zfs.writestr(
+        "_meta/_catalog",
+        json.dumps(build_catalog(dict_of_dataframes, sizes), default=str),
+    )
+    print("catalog time", time.time() - s)
     zfs.writestr("_meta/_to_wide_columns", json.dumps(to_wide_columns))
     zfs.writestr("_meta/_data_format", "parquet")
     zfs.close()
@@ -347,6 +412,43 @@ def create_biobank(dict_of_dataframes, name, revision, filename, to_wide_columns
         for idx, row in df.iterrows():
             if row.dtype != float:
                 print("Error in %s %s, dtype was %s" % (ds, idx, row.dtype))
+    if store_wide:
+        write_wide(bb, filename)
+
+
+def write_wide(bb, filename):
+    """Append the default get_wide() of every dataset in @bb to @filename.
+    Closes @bb - the file can't be appended to while it's open (and memory mapped)."""
+    import pyarrow
+    import pyarrow.parquet
+    from . import _frame_to_table, stored_wide_prefix
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        written = []
+        for ds in bb.list_datasets():
+            print("storing wide", ds)
+            try:
+                df = bb.get_wide(ds)
+            except WideNotSupported:
+                continue
+            try:
+                table = _frame_to_table(df)
+            except (pyarrow.ArrowException, TypeError, ValueError) as e:
+                print("could not store wide for %s: %s" % (ds, e))
+                continue
+            finally:
+                del df
+                bb.clear_cache()
+            # straight to disk, so only one wide DataFrame is in memory at a time
+            tf = os.path.join(tmp_dir, str(len(written)))
+            pyarrow.parquet.write_table(table, tf)
+            del table
+            written.append((ds, tf))
+        bb.close()
+        zfs = zipfile.ZipFile(filename, "a")
+        for ds, tf in written:
+            zfs.write(tf, stored_wide_prefix + ds)
+        zfs.close()
 
 
 def split_seperate_me(out_df, in_order=["patient", "compartment"]):